@@ -13,65 +13,239 @@
 # limitations under the License.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import itertools
 import logging
+from typing import (Any, Callable, Iterable, Iterator, List, Mapping, Optional,
+                    Sequence, Tuple)
 from rich.logging import RichHandler
-from functools import reduce
 import pandas as pd
 import numpy as np
-from google.api_core.exceptions import Conflict
+try:
+    import numba
+except ImportError:
+    numba = None
 from google.cloud import bigquery
 from smart_open import open
 import yaml
 
 from gaarf.api_clients import GoogleAdsApiClient
+from gaarf.base_query import BaseQuery
 from gaarf.utils import get_customer_ids
 from gaarf.query_executor import AdsReportFetcher
+from gaarf.report import GaarfReport
 from gaarf.cli.utils import GaarfConfigBuilder
 
 import src.queries as queries
-from src.utils import write_data_to_bq
+from src.utils import write_dated_tables
+
+
+def _group_fill_indexer(codes: np.ndarray,
+                        is_valid: np.ndarray) -> np.ndarray:
+    """Builds forward fill indexer within contiguous groups of codes.
+
+    Each position points to the last valid position of the same group
+    (itself included) or -1 if there is no such position.
+    """
+    positions = np.arange(len(codes))
+    group_start = np.empty(len(codes), dtype=bool)
+    group_start[:1] = True
+    group_start[1:] = np.diff(codes) != 0
+    first_in_group = np.maximum.accumulate(np.where(group_start, positions, 0))
+    last_valid = np.maximum.accumulate(np.where(is_valid, positions, -1))
+    return np.where(last_valid >= first_in_group, last_valid, -1)
+
+
+def _fill_campaign_vectorized(codes: np.ndarray, value_old: np.ndarray,
+                              value_new: np.ndarray,
+                              current: np.ndarray) -> np.ndarray:
+    size = len(codes)
+    forward = _group_fill_indexer(codes, ~np.isnan(value_new))
+    backward = _group_fill_indexer(codes[::-1], ~np.isnan(value_old[::-1]))
+    # backward positions are mapped straight to value_old part of stacked values
+    backward = np.where(backward >= 0, 2 * size - 1 - backward, -1)[::-1]
+    indexer = np.where(forward >= 0, forward, backward)
+    filled = np.concatenate([value_new, value_old, [np.nan]]).take(indexer)
+    np.copyto(filled, current, where=np.isnan(filled))
+    return filled
+
+
+def _fill_campaign_loop(codes: np.ndarray, value_old: np.ndarray,
+                        value_new: np.ndarray,
+                        current: np.ndarray) -> np.ndarray:
+    size = len(codes)
+    filled = np.empty(size)
+    last_new = np.nan
+    for i in range(size):
+        if i == 0 or codes[i] != codes[i - 1]:
+            last_new = np.nan
+        if not np.isnan(value_new[i]):
+            last_new = value_new[i]
+        filled[i] = last_new
+    next_old = np.nan
+    for i in range(size - 1, -1, -1):
+        if i == size - 1 or codes[i] != codes[i + 1]:
+            next_old = np.nan
+        if not np.isnan(value_old[i]):
+            next_old = value_old[i]
+        if np.isnan(filled[i]):
+            filled[i] = current[i] if np.isnan(next_old) else next_old
+    return filled
+
+
+if numba is not None:
+    _fill_campaign_loop = numba.njit(cache=True)(_fill_campaign_loop)
+
+
+def fill_campaign(codes: np.ndarray, value_old: np.ndarray,
+                  value_new: np.ndarray, current: np.ndarray) -> np.ndarray:
+    """Fills values within each campaign (codes are expected to be sorted).
+
+    Rows are taken from the last known value_new for a campaign, rows before
+    the first change are taken from the nearest subsequent value_old and
+    rows of campaigns without any changes are taken from current.
+    Uses numba compiled loop when numba is installed.
+    """
+    if numba is not None:
+        return _fill_campaign_loop(codes, value_old, value_new, current)
+    return _fill_campaign_vectorized(codes, value_old, value_new, current)
 
 
 def restore_history(placeholder_df: pd.DataFrame,
                     partial_history: pd.DataFrame,
-                    current_values: pd.DataFrame, name: str) -> pd.DataFrame:
-    "Restores dimension history for every date and campaign_id within placeholder_df."
-    if not partial_history.empty:
-        joined = pd.merge(placeholder_df,
-                          partial_history,
-                          on=["campaign_id", "day"],
-                          how="left")
-        joined["filled_backward"] = joined.groupby(
-            "campaign_id")["value_old"].bfill()
-        joined["filled_forward"] = joined.groupby(
-            "campaign_id")["value_new"].ffill()
-        joined["filled_forward"] = joined.groupby(
-            "campaign_id")["filled_forward"].fillna(
-                joined.pop("filled_backward"))
-        joined = pd.merge(joined, current_values, on="campaign_id", how="left")
-        joined[name] = np.where(joined["filled_forward"].isnull(),
-                                joined[name], joined["filled_forward"])
-    else:
-        joined = pd.merge(placeholder_df,
-                          current_values,
-                          on="campaign_id",
-                          how="left")
-    if name != "target_roas":
-        joined[name] = joined[name].astype(int)
-    return joined[["day", "campaign_id", name]]
+                    current_values: Mapping[str, Mapping[int, float]],
+                    names: Sequence[str]) -> pd.DataFrame:
+    """Restores dimensions history for every date and campaign_id within placeholder_df.
+
+    Args:
+        placeholder_df: All combinations of campaign_id and day sorted by
+            campaign_id and day.
+        partial_history: Changes of dimensions (old_<name> and new_<name>
+            columns) indexed by day and campaign_id.
+        current_values: Latest value of each dimension by campaign_id.
+        names: Dimensions to restore.
+
+    Returns:
+        DataFrame with a column for each dimension indexed by day and
+        campaign_id.
+    """
+    # left joins keep placeholder_df order so no re-sorting is required
+    joined = placeholder_df.set_index(["day", "campaign_id"]).join(
+        partial_history, how="left").reset_index()
+    index = pd.MultiIndex.from_arrays([joined["day"], joined["campaign_id"]])
+    codes = joined["campaign_id"].to_numpy()
+    restored = []
+    for name in names:
+        values = joined["campaign_id"].map(
+            current_values[name]).to_numpy(dtype=float)
+        if f"old_{name}" in joined:
+            values = fill_campaign(
+                codes, joined[f"old_{name}"].to_numpy(dtype=float),
+                joined[f"new_{name}"].to_numpy(dtype=float), values)
+        elif name != "target_roas" and np.isnan(values).all():
+            # neither changes nor current values, dimension is zero everywhere
+            restored.append(
+                pd.Series(np.broadcast_to(np.int64(0), len(index)),
+                          index=index,
+                          name=name))
+            continue
+        dimension = pd.Series(values, index=index, name=name)
+        if name != "target_roas":
+            # micros overflow int32 for amounts above 2,147 currency units
+            dimension = dimension.astype(np.int64)
+        restored.append(dimension)
+    return pd.concat(restored, axis=1)
 
 
 def format_partial_change_history(df: pd.DataFrame,
                                   dimension_name: str) -> pd.DataFrame:
-    """Performs renaming and selecting last value for the date."""
-    df.loc[:, ("day")] = df["change_date"].str.split(expand=True)[0]
-    df = df.rename(columns={
-        f"old_{dimension_name}": "value_old",
-        f"new_{dimension_name}": "value_new"
-    })[["day", "campaign_id", "value_old", "value_new"]]
-    return df.groupby(["day", "campaign_id"]).last()
+    """Selects last value of the dimension for the date.
+
+    Events without both old and new values are skipped; unlike per column
+    groupby().last() a null new value of the last event is kept as is
+    (gaarf returns 0 rather than null for these fields).
+    """
+    values = [f"old_{dimension_name}", f"new_{dimension_name}"]
+    df = df.dropna(subset=values, how="all")
+    df = df.assign(day=pd.to_datetime(df["change_date"].str.slice(0, 10),
+                                      format="%Y-%m-%d"))[[
+        "day", "campaign_id", *values
+    ]]
+    return df.drop_duplicates(["day", "campaign_id"],
+                              keep="last").set_index(["day", "campaign_id"])
+
+
+def select_changes(report: GaarfReport,
+                   column_names: Sequence[str]) -> Tuple[List[str], List[list]]:
+    """Selects rows of report with positive value in any of column_names.
+
+    Returns:
+        Column names of the report and the selected rows.
+    """
+    report_columns = report.column_names
+    # skip placeholder row of reports without any results
+    if not report:
+        return report_columns, []
+    positions = [report_columns.index(name) for name in column_names]
+    return report_columns, [
+        row for row in report.results
+        if any((row[position] or 0) > 0 for position in positions)
+    ]
+
+
+def changes_to_pandas(
+        changes: Iterable[Tuple[List[str], List[list]]]) -> pd.DataFrame:
+    """Concatenates rows selected by select_changes into a DataFrame."""
+    rows = []
+    report_columns = None
+    for report_columns, selected_rows in changes:
+        rows.extend(selected_rows)
+    return pd.DataFrame(data=rows, columns=report_columns)
+
+
+def reports_to_pandas(reports: Iterable[GaarfReport]) -> pd.DataFrame:
+    """Concatenates reports skipping placeholders of reports without results."""
+    reports = list(reports)
+    frames = [report.to_pandas() for report in reports if report]
+    if not frames:
+        return reports[0].to_pandas()
+    return pd.concat(frames, ignore_index=True)
+
+
+def fetch_reports(google_ads_client: GoogleAdsApiClient,
+                  customer_ids: Sequence[str],
+                  query: BaseQuery,
+                  chunk_size: int = 10,
+                  max_workers: int = 16,
+                  transform: Optional[Callable[[GaarfReport], Any]] = None
+                  ) -> Iterator[Any]:
+    """Fetches query for chunks of customer_ids concurrently.
+
+    Reports are yielded in the order of chunks. When transform is provided
+    it is applied to each report within the worker thread and its result
+    is yielded instead, so only transformed reports are kept in memory.
+    """
+    if transform is None:
+        transform = lambda report: report
+    customer_ids_chunks = [
+        customer_ids[i:i + chunk_size]
+        for i in range(0, len(customer_ids), chunk_size)
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(
+            lambda chunk: transform(
+                AdsReportFetcher(google_ads_client, chunk).fetch(query)),
+            customer_ids_chunks)
+
+
+def encode_campaign_ids(df: pd.DataFrame,
+                        categories: pd.Index) -> pd.DataFrame:
+    """Replaces campaign_id with int32 code of its position in categories.
+
+    campaign_ids missing from categories are encoded as -1.
+    """
+    codes = pd.Categorical(df["campaign_id"], categories=categories).codes
+    return df.assign(campaign_id=codes.astype(np.int32))
 
 
 def main():
@@ -103,10 +277,7 @@ def main():
     # Change history can be fetched only for the last 29 days
     days_ago_29 = (datetime.now() - timedelta(days=29)).strftime("%Y-%m-%d")
     days_ago_1 = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    dates = [
-        date.strftime("%Y-%m-%d") for date in pd.date_range(
-            days_ago_29, days_ago_1).to_pydatetime().tolist()
-    ]
+    dates = pd.date_range(days_ago_29, days_ago_1).values
     config = GaarfConfigBuilder(args).build()
     bq_project = config.writer_params.get("project")
     bq_dataset = config.writer_params.get("dataset")
@@ -117,91 +288,100 @@ def main():
                                            version=f"v{config.api_version}")
     customer_ids = get_customer_ids(google_ads_client, config.account,
                                     config.customer_ids_query)
-    logger.info("Restoring change history for %d accounts: %s",
-                len(customer_ids), customer_ids)
-    report_fetcher = AdsReportFetcher(google_ads_client, customer_ids)
-
-    # extract change history report
-    change_history = report_fetcher.fetch(
-        queries.ChangeHistory(days_ago_29, days_ago_1)).to_pandas()
-
-    logger.info("Restoring change history for %d accounts: %s",
-                len(customer_ids), customer_ids)
-    # Filter rows where budget change occurred
-    budgets = change_history.loc[(change_history["old_budget_amount"] > 0)
-                                 & (change_history["new_budget_amount"] > 0)]
-    if not budgets.empty:
-        budgets = format_partial_change_history(budgets, "budget_amount")
-        logger.info("%d budgets events were found", len(budgets))
-    else:
-        logger.info("no budgets events were found")
+    logger.info("Restoring change history for %d accounts",
+                len(customer_ids))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Accounts: %s", customer_ids)
 
-    # Filter rows where bid change occurred
-    target_cpas = change_history.loc[change_history["old_target_cpa"] > 0]
-    if not target_cpas.empty:
-        target_cpas = format_partial_change_history(target_cpas, "target_cpa")
-        logger.info("%d target_cpa events were found", len(target_cpas))
-    else:
-        logger.info("no target_cpa events were found")
+    if not customer_ids:
+        logger.warning("No accounts found, change history is not restored")
+        return
+
+    # extract change history report, only changed rows of each chunk of
+    # accounts are kept to limit peak memory
+    change_history = changes_to_pandas(
+        fetch_reports(
+            google_ads_client,
+            customer_ids,
+            queries.ChangeHistory(days_ago_29, days_ago_1),
+            transform=lambda report: select_changes(
+                report,
+                ["old_budget_amount", "old_target_cpa", "old_target_roas"])))
 
-    target_roas = change_history.loc[change_history["old_target_roas"] > 0]
-    if not target_roas.empty:
-        target_roas = format_partial_change_history(target_roas, "target_roas")
-        logger.info("%d target_roas events were found", len(target_roas))
-    else:
-        logger.info("no target_roas events were found")
     # get all campaigns with an non-zero impressions to build placeholders df
-    campaign_ids = report_fetcher.fetch(
-        queries.CampaignsWithSpend(days_ago_29, days_ago_1)).to_pandas()
+    campaign_ids = reports_to_pandas(
+        fetch_reports(google_ads_client, customer_ids,
+                      queries.CampaignsWithSpend(days_ago_29, days_ago_1)))
     logger.info("Change history will be restored for %d campaign_ids",
                 len(campaign_ids))
+    # campaign_ids are replaced with int32 codes until history is restored
+    campaign_categories = pd.Categorical(campaign_ids.campaign_id).categories
+    change_history = encode_campaign_ids(change_history, campaign_categories)
+
+    # Filter rows where budget or bid change occurred
+    dimension_changes = {
+        "budget_amount": (change_history["old_budget_amount"] > 0)
+        & (change_history["new_budget_amount"] > 0),
+        "target_cpa": change_history["old_target_cpa"] > 0,
+        "target_roas": change_history["old_target_roas"] > 0
+    }
+    partial_histories = []
+    for name, has_changed in dimension_changes.items():
+        events = change_history.loc[has_changed]
+        if not events.empty:
+            events = format_partial_change_history(events, name)
+            logger.info("%d %s events were found", len(events), name)
+            partial_histories.append(events)
+        else:
+            logger.info("no %s events were found", name)
+    if partial_histories:
+        partial_change_history = pd.concat(partial_histories, axis=1)
+    else:
+        partial_change_history = pd.DataFrame(index=pd.MultiIndex.from_arrays(
+            [pd.DatetimeIndex([]), []], names=["day", "campaign_id"]))
 
     # get latest bids and budgets to replace values in campaigns without any changes
-    current_bids_budgets_active_campaigns = report_fetcher.fetch(
-        queries.BidsBudgetsActiveCampaigns()).to_pandas()
-    current_bids_budgets_inactive_campaigns = report_fetcher.fetch(
-        queries.BidsBudgetsInactiveCampaigns(days_ago_29,
-                                             days_ago_1)).to_pandas()
-    current_bids_budgets = pd.concat([
-        current_bids_budgets_inactive_campaigns,
-        current_bids_budgets_active_campaigns
-    ],
-                                     sort=False).drop_duplicates()
+    current_bids_budgets_active_campaigns = reports_to_pandas(
+        fetch_reports(google_ads_client, customer_ids,
+                      queries.BidsBudgetsActiveCampaigns()))
+    current_bids_budgets_inactive_campaigns = reports_to_pandas(
+        fetch_reports(google_ads_client, customer_ids,
+                      queries.BidsBudgetsInactiveCampaigns(
+                          days_ago_29, days_ago_1)))
+    current_bids_budgets = encode_campaign_ids(
+        pd.concat([
+            current_bids_budgets_inactive_campaigns,
+            current_bids_budgets_active_campaigns
+        ],
+                  sort=False).drop_duplicates(), campaign_categories)
+    current_values = {
+        name: dict(
+            zip(current_bids_budgets["campaign_id"],
+                current_bids_budgets[name]))
+        for name in dimension_changes
+    }
 
     # generate a placeholder dataframe that contain possible variations of
     # campaign_ids with non-zero impressions and last 29 days date range
-    placeholders = pd.DataFrame(data=list(
-        itertools.product(list(campaign_ids.campaign_id.values), dates)),
-                                columns=["campaign_id", "day"])
-
-    restored_budgets = restore_history(placeholders, budgets,
-                                       current_bids_budgets, "budget_amount")
-    restored_target_cpas = restore_history(placeholders, target_cpas,
-                                           current_bids_budgets, "target_cpa")
-    restored_target_roas = restore_history(placeholders, target_roas,
-                                           current_bids_budgets, "target_roas")
-    # Combine restored change histories
-    restored_bid_budget_history = reduce(
-        lambda left, right: pd.merge(
-            left, right, on=["day", "campaign_id"], how="left"),
-        [restored_budgets, restored_target_cpas, restored_target_roas])
+    placeholder_campaign_ids = np.arange(len(campaign_categories),
+                                         dtype=np.int32)
+    placeholders = pd.MultiIndex.from_product(
+        [placeholder_campaign_ids, dates],
+        names=["campaign_id", "day"]).to_frame(index=False)
+
+    restored_bid_budget_history = restore_history(
+        placeholders, partial_change_history, current_values,
+        list(dimension_changes)).reset_index()
+    restored_bid_budget_history["campaign_id"] = campaign_categories.take(
+        restored_bid_budget_history["campaign_id"].values)
 
     # Writer data for each date to BigQuery dated table (with _YYYYMMDD suffix)
+    restored_bid_budget_history["day"] = restored_bid_budget_history[
+        "day"].dt.date
     bq_client = bigquery.Client(bq_project)
-    for date in dates:
-        daily_history = restored_bid_budget_history.loc[
-            restored_bid_budget_history["day"] == date]
-        daily_history.loc[:, ("day")] = datetime.strptime(date,
-                                                          "%Y-%m-%d").date()
-        table_id = f"{bq_project}.{bq_dataset}.bid_budgets_{date.replace('-','')}"
-        try:
-            write_data_to_bq(bq_client=bq_client,
-                             data=daily_history,
-                             table_id=table_id,
-                             write_disposition="WRITE_EMPTY")
-            logger.info("table '%s' has been created", table_id)
-        except Conflict as e:
-            logger.warning("table '%s' already exists", table_id)
+    write_dated_tables(bq_client=bq_client,
+                       data=restored_bid_budget_history,
+                       table_prefix=f"{bq_project}.{bq_dataset}.bid_budgets")
 
 
 if __name__ == "__main__":
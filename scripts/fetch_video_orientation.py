@@ -204,8 +204,7 @@ def main():
             parsed_videos = bq_executor.execute(script_name="existing_videos",
                                                 query_text="""
                 SELECT DISTINCT
-                    video_id,
-                    video_orientation
+                    video_id
                 FROM {bq_dataset}.video_orientation
                 """,
                                                 params=bq_config.params)
@@ -12,15 +12,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+from typing import Optional
+from uuid import uuid4
+from google.api_core.exceptions import Conflict
 from google.cloud import bigquery
 
+logger = logging.getLogger(__name__)
+
 
 def write_data_to_bq(bq_client: bigquery.Client,
                      data,
                      table_id: str,
-                     write_disposition: str = "WRITE_TRUNCATE") -> None:
+                     write_disposition: str = "WRITE_TRUNCATE",
+                     partition_field: Optional[str] = None) -> None:
     job_config = bigquery.LoadJobConfig(write_disposition=write_disposition, )
+    if partition_field:
+        job_config.time_partitioning = bigquery.TimePartitioning(
+            field=partition_field)
     job = bq_client.load_table_from_dataframe(data,
                                               table_id,
                                               job_config=job_config)
     job.result()
+
+
+def _create_dated_table(bq_client: bigquery.Client, staging_table_id: str,
+                        table_id: str, date_column: str, date) -> None:
+    query = f"""
+    CREATE TABLE `{table_id}` AS
+    SELECT * FROM `{staging_table_id}`
+    WHERE {date_column} = DATE '{date}'
+    """
+    bq_client.query(query).result()
+
+
+def write_dated_tables(bq_client: bigquery.Client,
+                       data,
+                       table_prefix: str,
+                       date_column: str = "day",
+                       max_workers: int = 8) -> None:
+    """Writes data for each date to dated table with _YYYYMMDD suffix.
+
+    Data is loaded with a single job into a staging table partitioned by
+    date_column so each dated table reads only its own partition; dated
+    tables are then created from it concurrently, already existing dated
+    tables are left intact. Staging table name has a per-run suffix so
+    concurrent runs do not overwrite or delete each other's data.
+    """
+    # project may contain dots itself (e.g. example.com:my-project)
+    dataset_path, table = table_prefix.rsplit(".", 1)
+    staging_table_id = f"{dataset_path}.staging_{table}_{uuid4().hex[:8]}"
+    write_data_to_bq(bq_client=bq_client,
+                     data=data,
+                     table_id=staging_table_id,
+                     partition_field=date_column)
+    table_ids = {
+        date: f"{table_prefix}_{str(date).replace('-', '')}"
+        for date in sorted(data[date_column].unique())
+    }
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_create_dated_table, bq_client,
+                                staging_table_id, table_id, date_column, date):
+                table_id
+                for date, table_id in table_ids.items()
+            }
+            for future in as_completed(futures):
+                table_id = futures[future]
+                try:
+                    future.result()
+                    logger.info("table '%s' has been created", table_id)
+                except Conflict:
+                    logger.warning("table '%s' already exists", table_id)
+    finally:
+        bq_client.delete_table(staging_table_id, not_found_ok=True)